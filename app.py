@@ -6,21 +6,40 @@
 # Gemini 2.5 Pro | Sheets Integration | Insurance & Depreciation Tables
 # ===========================================================
 
-import os, json, re, hashlib, time, html
+import os, io, json, re, hashlib, time, html, queue, threading, atexit, random, tempfile, logging
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import streamlit as st
-from json_repair import repair_json
 
-# Optional Google Sheets
 try:
-    import gspread
-    from google.oauth2.service_account import Credentials
-except Exception:
-    gspread = None
-    Credentials = None
+    import orjson
+except ImportError:  # stdlib stand-in with the call shapes used here (bytes out, append-newline option)
+    class orjson:
+        OPT_APPEND_NEWLINE = 1
+        JSONDecodeError = json.JSONDecodeError
+
+        @staticmethod
+        def loads(data):
+            return json.loads(data)
+
+        @staticmethod
+        def dumps(obj, option=0):
+            out = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            return out + b"\n" if option & 1 else out
 
 # Google Generative AI (Gemini)
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+try:
+    import fcntl  # POSIX advisory locks for the shared history log
+except ImportError:  # Windows: appends stay unlocked
+    fcntl = None
+
+log = logging.getLogger("deal_checker")
 
 # -------------------------------------------------------------
 # CONFIG
@@ -29,8 +48,9 @@ APP_VERSION = "10.2.0"
 st.set_page_config(page_title="AI Deal Checker", page_icon="🚗", layout="centered")
 
 # --- AUTO THEME for Android + iOS Safari (No Buttons) ---
-def inject_auto_theme():
-    st.markdown("""
+# Constant markup, built once at import. It must still be emitted on every rerun:
+# Streamlit drops any element the current run doesn't re-create.
+_THEME_CSS = """
     <style>
     :root { color-scheme: light dark; }
 
@@ -85,9 +105,9 @@ def inject_auto_theme():
     .grid3 { display:grid; grid-template-columns:repeat(3,1fr); gap:10px; }
     .grid2 { display:grid; grid-template-columns:repeat(2,1fr); gap:10px; }
     </style>
-    """, unsafe_allow_html=True)
+    """
 
-    st.markdown("""
+_THEME_JS = """
     <script>
     (function(){
       try {
@@ -101,7 +121,11 @@ def inject_auto_theme():
       } catch(e) {}
     })();
     </script>
-    """, unsafe_allow_html=True)
+    """
+
+def inject_auto_theme():
+    st.markdown(_THEME_CSS, unsafe_allow_html=True)
+    st.markdown(_THEME_JS, unsafe_allow_html=True)
 
 inject_auto_theme()
 
@@ -113,29 +137,65 @@ st.caption(
 API_KEY = st.secrets.get("GEMINI_API_KEY", "")
 SHEET_ID = st.secrets.get("GOOGLE_SHEET_ID", "")
 SERVICE_JSON = st.secrets.get("GOOGLE_SERVICE_ACCOUNT_JSON", None)
-LOCAL_FILE = "deal_history_us.json"
+# >1 allows up to that many hedged Gemini calls per attempt: another starts when none has answered within
+# HEDGE_AFTER seconds or one returns bad JSON, so the extra cost is only paid on slow/failed calls; off by default
+try:
+    PARALLEL_ATTEMPTS = max(1, int(st.secrets.get("GEMINI_PARALLEL_ATTEMPTS", 1)))
+except (TypeError, ValueError):
+    PARALLEL_ATTEMPTS = 1
+try:
+    # sequential attempts per click; backoff between them doubles from the second retry on
+    MAX_ATTEMPTS = max(1, int(st.secrets.get("GEMINI_ATTEMPTS", 2)))
+except (TypeError, ValueError):
+    MAX_ATTEMPTS = 2
+try:
+    HEDGE_AFTER = max(0.0, float(st.secrets.get("GEMINI_HEDGE_AFTER", 45)))  # 0 = launch all at once
+except (TypeError, ValueError):
+    HEDGE_AFTER = 45.0
+LOCAL_FILE = "deal_history_us.jsonl"
+LEGACY_FILE = "deal_history_us.json"  # pre-JSONL array format, migrated on first load/save
 MEMORY_LIMIT = 600
+MODEL_NAME = "gemini-2.5-pro"
+IMAGE_MAX_SIDE = 1024  # long edge sent to Gemini; plenty for panel/tire/interior cues
+SCOPES = ("https://www.googleapis.com/auth/spreadsheets",)
 
 if not API_KEY:
     st.error("Missing GEMINI_API_KEY in Streamlit secrets.")
     st.stop()
 
-genai.configure(api_key=API_KEY)
-model = genai.GenerativeModel("gemini-2.5-pro")
+# Built once per process; Streamlit reruns the script on every widget interaction
+@st.cache_resource(show_spinner=False)
+def get_model():
+    genai.configure(api_key=API_KEY)
+    return genai.GenerativeModel(MODEL_NAME)
+
+
+@st.cache_resource(show_spinner=False)
+def get_sheet():
+    if not (SHEET_ID and SERVICE_JSON):
+        return None
+    # Optional Google Sheets — imported only when configured, so Sheets-less deploys skip the cost
+    try:
+        import gspread
+        from google.oauth2.service_account import Credentials
+    except Exception:
+        return None
+    info = json.loads(SERVICE_JSON) if isinstance(SERVICE_JSON, str) else SERVICE_JSON
+    creds = Credentials.from_service_account_info(info, scopes=SCOPES)
+    return gspread.authorize(creds).open_by_key(SHEET_ID).sheet1
+
+
+model = get_model()
 
 # ---------------- Sheets -----------------
 sheet = None
-if SHEET_ID and SERVICE_JSON and gspread and Credentials:
-    try:
-        if isinstance(SERVICE_JSON, str):
-            SERVICE_JSON = json.loads(SERVICE_JSON)
-        creds = Credentials.from_service_account_info(
-            SERVICE_JSON, scopes=["https://www.googleapis.com/auth/spreadsheets"]
-        )
-        sheet = gspread.authorize(creds).open_by_key(SHEET_ID).sheet1
+try:
+    sheet = get_sheet()
+    if sheet and not st.session_state.get("_sheets_toast"):
         st.toast("✅ Connected to Google Sheets")
-    except Exception as e:
-        st.warning(f"⚠️ Sheets connection failed: {e}")
+        st.session_state["_sheets_toast"] = True
+except Exception as e:
+    st.warning(f"⚠️ Sheets connection failed: {e}")
 
 # -------------------------------------------------------------
 # U.S.-SPECIFIC TABLES
@@ -166,18 +226,34 @@ INSURANCE_COST = {"MI": 2800, "FL": 2400, "NY": 2300, "OH": 1100, "TX": 1700, "C
 # -------------------------------------------------------------
 # HELPERS
 # -------------------------------------------------------------
-def meter(label, value, suffix=""):
+_WS_RE = re.compile(r"\s+")
+_PRICE_RE = re.compile(r"(?i)(?:\$?\s*)(\d{1,3}(?:,\d{3})+|\d{4,6})(?:\s*usd)?")
+_NON_TOKEN_RE = re.compile(r"[^a-z0-9 ]+")
+_STATE_RE = re.compile(r"[A-Z]{2}")
+_ZIP_RE = re.compile(r"\d{5}")
+
+
+# score bands: index = bisect_right(thresholds, score), so each label list has len(thresholds) + 1 entries
+_FILL_THRESH = (40, 70)
+_FILL_CLS = ("fill-bad", "fill-warn", "fill-ok")
+
+
+def meter_html(label, value, suffix=""):
     try:
         v = float(value)
     except Exception:
         v = 0
     v = max(0, min(100, v))
-    css = "fill-ok" if v >= 70 else ("fill-warn" if v >= 40 else "fill-bad")
-    st.markdown(
-        f"<div class='metric'><b>{html.escape(str(label))}</b><span class='kpi'>{int(v)}{html.escape(str(suffix))}</span></div>",
-        unsafe_allow_html=True,
+    css = _FILL_CLS[bisect_right(_FILL_THRESH, v)]
+    return (
+        f"<div class='metric'><b>{html.escape(str(label))}</b><span class='kpi'>{int(v)}{html.escape(str(suffix))}</span></div>"
+        f"<div class='progress'><div class='{css}' style='width:{v}%'></div></div>"
     )
-    st.markdown(f"<div class='progress'><div class='{css}' style='width:{v}%'></div></div>", unsafe_allow_html=True)
+
+
+def meter(label, value, suffix=""):
+    # label row + bar in one element (one delta to the browser instead of two)
+    st.markdown(meter_html(label, value, suffix), unsafe_allow_html=True)
 
 
 def clip(x, lo, hi):
@@ -191,8 +267,8 @@ def clip(x, lo, hi):
 def extract_price_from_text(txt: str):
     if not txt:
         return None
-    t = re.sub(r"\s+", " ", txt)
-    m = re.search(r"(?i)(?:\$?\s*)(\d{1,3}(?:,\d{3})+|\d{4,6})(?:\s*usd)?", t)
+    t = _WS_RE.sub(" ", txt)
+    m = _PRICE_RE.search(t)
     if m:
         try:
             return float(m.group(1).replace(",", ""))
@@ -201,12 +277,179 @@ def extract_price_from_text(txt: str):
     return None
 
 
+def close_truncated_json(text: str):
+    """Append the closers a cut-off reply is missing, innermost first (string-aware); None if nothing is open."""
+    closers, in_str, esc = [], False, False
+    for ch in text:
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{":
+            closers.append("}")
+        elif ch == "[":
+            closers.append("]")
+        elif (ch == "}" or ch == "]") and closers:
+            closers.pop()
+    if not closers:
+        return None
+    if in_str:
+        text = (text[:-1] if esc else text) + '"'
+    else:
+        text = text.rstrip().rstrip(",")
+    return text + "".join(reversed(closers))
+
+
 def parse_json_safe(raw: str):
-    raw = (raw or "").replace("```json", "").replace("```", "").strip()
+    raw = (raw or "").strip()
+    # fences only ever wrap the reply; slice them off instead of scanning the whole text twice with replace()
+    if raw.startswith("```"):
+        nl = raw.find("\n")
+        raw = raw[nl + 1:] if nl > 0 else raw[3:]
+    if raw.endswith("```"):
+        raw = raw[:-3]
+    raw = raw.strip()
     try:
-        return json.loads(raw)
+        return orjson.loads(raw)  # fast path: well-formed reply, repair never runs
+    except orjson.JSONDecodeError:
+        pass
+    # truncated reply (token limit / dropped stream): closing the open brackets usually suffices
+    start = raw.find("{")
+    closed = close_truncated_json(raw[start:]) if start >= 0 else None
+    if closed:
+        try:
+            return orjson.loads(closed)
+        except orjson.JSONDecodeError:
+            pass
+    # slow path: drop chatter before the object; keep a truncated tail intact so repair can
+    # recover its fields, and trim only text after the final } of a balanced object
+    body = raw[start:] if start >= 0 else raw
+    if start >= 0 and closed is None:
+        body = body[:body.rfind("}") + 1] or body
+        try:
+            return orjson.loads(body)  # trailing prose after the closing brace is the common case
+        except orjson.JSONDecodeError:
+            pass
+    from json_repair import repair_json  # only broken replies need it; keeps it off the cold-start path
+    # return_objects hands back the repaired object directly; skip_json_loads drops the
+    # validation json.loads repair_json would otherwise run (we know the text is broken)
+    return repair_json(body, return_objects=True, skip_json_loads=True)
+
+
+def prompt_json(obj) -> str:
+    # compact orjson output for prompts: same content as json.dumps, fewer tokens (no ", " / ": " padding)
+    try:
+        return orjson.dumps(obj).decode()
+    except TypeError:  # values orjson rejects but json.dumps took (ints past 64 bits, non-str keys)
+        return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+def _num(x, default=None):
+    try:
+        return float(x)
+    except Exception:
+        return default
+
+
+def normalize_output(data):
+    """Coerce parsed model JSON into the shape the render path reads (one pass, in place)."""
+    if not isinstance(data, dict):
+        raise ValueError("model output is not a JSON object")
+    for k in ("from_ad", "vehicle_facts", "market_refs", "roi_forecast_24m", "roi_forecast", "benchmark"):
+        if not isinstance(data.get(k), dict):
+            data[k] = {}
+    for k in ("risk_tier", "relative_rank", "buyer_fit", "verification_summary", "score_explanation"):
+        v = data.get(k)
+        data[k] = v.strip() if isinstance(v, str) else ""
+    comps = data.get("components")
+    data["components"] = [
+        {"name": str(c.get("name") or ""), "score": c.get("score", 0), "note": str(c.get("note") or "")}
+        for c in (comps if isinstance(comps, list) else [])
+        if isinstance(c, dict)
+    ]
+    data["ask_price_usd"] = _num(data.get("ask_price_usd"), 0.0)
+    data["confidence_level"] = _num(data.get("confidence_level", 0.7), 0.7)
+    data["web_search_performed"] = bool(data.get("web_search_performed", False))
+    refs = data["market_refs"]
+    refs["gap_pct"] = _num(refs.get("gap_pct"))
+    refs["median_clean"] = _num(refs.get("median_clean"), 0.0)
+    facts = data["vehicle_facts"]
+    facts["title_status"] = str(facts.get("title_status") or "unknown").strip().lower()
+    facts["state_or_zip"] = str(facts.get("state_or_zip") or "").strip().upper()
+    return data
+
+
+def prep_image(data: bytes, mime: str):
+    """Downscale to IMAGE_MAX_SIDE and re-encode as JPEG q85; falls back to the original bytes."""
+    try:
+        from PIL import Image, ImageOps  # imported on first upload, not at app start
+
+        im = Image.open(io.BytesIO(data))
+        im.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))  # JPEG: let libjpeg decode at 1/2..1/8 scale
+        im = ImageOps.exif_transpose(im)  # re-encoding drops EXIF, so bake in the phone's rotation
+        im.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        buf = io.BytesIO()
+        im.save(buf, "JPEG", quality=85, optimize=True)
+        out = buf.getvalue()
+        return ("image/jpeg", out) if len(out) < len(data) else (mime, data)
     except Exception:
-        return json.loads(repair_json(raw))
+        return mime, data
+
+
+PREPARED_IMAGES_MAX = 64
+_PREPARED_LOCK = threading.Lock()  # the store is shared by every session/script thread
+
+
+@st.cache_resource(show_spinner=False)
+def _prepared_images():
+    # blake2b(original upload bytes) -> prepared Gemini part, least recently used first;
+    # reruns/re-clicks skip the re-encode
+    return OrderedDict()
+
+
+def prep_upload(raw: bytes, mime: str):
+    mime, blob = prep_image(raw, mime)
+    return {"mime_type": mime, "data": blob}
+
+
+def prep_uploads(imgs):
+    """Uploaded files -> Gemini inline parts; new files are encoded concurrently (Pillow releases the GIL)."""
+    store = _prepared_images()
+    order, uploads = [], {}
+    for img in imgs or []:
+        try:
+            raw = img.getvalue()
+            mime = "image/png" if "png" in img.type.lower() else "image/jpeg"
+        except Exception:
+            continue  # one bad file doesn't abort the batch
+        d = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        order.append(d)
+        uploads[d] = (raw, mime)
+    # snapshot the hits (refreshing their recency) so another session's eviction can't pull them mid-call
+    with _PREPARED_LOCK:
+        ready = {}
+        for d in uploads:
+            part = store.get(d)
+            if part is not None:
+                store.move_to_end(d)
+                ready[d] = part
+    todo = {d: item for d, item in uploads.items() if d not in ready}
+    if todo:
+        with ThreadPoolExecutor(max_workers=min(8, len(todo))) as ex:
+            done = dict(zip(todo.keys(), ex.map(lambda item: prep_upload(*item), todo.values())))
+        ready.update(done)
+        with _PREPARED_LOCK:
+            store.update(done)
+            while len(store) > PREPARED_IMAGES_MAX:
+                store.popitem(last=False)
+    return [ready[d] for d in order]
 
 
 def unique_ad_id(ad_text, vin, zip_or_state, price_guess, seller):
@@ -217,62 +460,466 @@ def unique_ad_id(ad_text, vin, zip_or_state, price_guess, seller):
 def token_set(text):
     if not text:
         return set()
-    t = re.sub(r"[^a-z0-9 ]+", " ", str(text).lower())
+    t = _NON_TOKEN_RE.sub(" ", str(text).lower())
     return {w for w in t.split() if len(w) > 2}
 
 
-def similarity_score(ad_a, ad_b):
-    ta, tb = token_set(ad_a.get("raw_text")), token_set(ad_b.get("raw_text"))
+def similarity_score(ta, p_a, loc_a, tb, p_b, loc_b):
     j = len(ta & tb) / max(1, len(ta | tb))
-    p_a, p_b = float(ad_a.get("price_guess") or 0), float(ad_b.get("price_guess") or 0)
     price_sim = 1.0 - min(1.0, abs(p_a - p_b) / max(1000.0, max(p_a, p_b, 1.0)))
-    loc_sim = 1.0 if (ad_a.get("zip_or_state") == ad_b.get("zip_or_state")) else 0.7
+    loc_sim = 1.0 if loc_a == loc_b else 0.7
     return 0.6 * j + 0.3 * price_sim + 0.1 * loc_sim
 
 
-def load_history():
-    if os.path.exists(LOCAL_FILE):
+def history_context(index, must_id, current_struct):
+    """Single pass over history -> (exact_prev, top-5 similar anchors, similar_avg)."""
+    exact_prev = index["by_id"].get(must_id)
+    cur_tokens = token_set(current_struct.get("raw_text"))
+    cur_price = float(current_struct.get("price_guess") or 0)
+    cur_loc = current_struct.get("zip_or_state")
+    sims = []
+    for uid, score, when, tokens, price, loc in index["rows"]:
+        if uid == must_id:
+            continue
+        s = similarity_score(cur_tokens, cur_price, cur_loc, tokens, price, loc)
+        if s >= 0.85:
+            sims.append({"id": uid, "score": score, "when": when, "sim": round(s, 3)})
+    sims = sorted(sims, key=lambda x: -x["sim"])[:5]
+    similar_avg = None
+    if sims:
+        vals = [v["score"] for v in sims if isinstance(v.get("score"), (int, float))]
+        similar_avg = round(sum(vals) / len(vals), 2) if vals else None
+    return exact_prev, sims, similar_avg
+
+
+@contextmanager
+def _history_lock():
+    # held around appends and compaction, so a rewrite can't drop another session's append
+    if fcntl is None:
+        yield
+        return
+    with open(LOCAL_FILE + ".lock", "ab") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
         try:
-            with open(LOCAL_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def history_line(entry) -> bytes:
+    # same fallback as prompt_json: model-sourced values orjson rejects (ints past 64 bits, non-str keys)
+    # must not fail the save, or the Sheets row is never queued either
+    try:
+        return orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+    except TypeError:
+        return (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+def history_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)  # lines orjson won't read back, e.g. big ints written by the fallback above
+
+
+def _write_history(rows):
+    # full rewrite (legacy migration / compaction only, caller holds _history_lock); the hot path appends.
+    # unique tmp name in the same directory, so concurrent writers never share it and os.replace stays atomic
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(LOCAL_FILE) + ".", suffix=".tmp",
+                               dir=os.path.dirname(os.path.abspath(LOCAL_FILE)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for r in rows:
+                f.write(history_line(r))
+        os.replace(tmp, LOCAL_FILE)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _migrate_legacy_history():
+    if os.path.exists(LOCAL_FILE) or not os.path.exists(LEGACY_FILE):
+        return
+    try:
+        with _history_lock():
+            if os.path.exists(LOCAL_FILE):  # another session migrated (and maybe appended) first
+                return
+            with open(LEGACY_FILE, "rb") as f:
+                rows = history_loads(f.read())
+            _write_history(rows[-MEMORY_LIMIT:])
+    except Exception:
+        pass
+
+
+def _history_stamp():
+    # cache key for the history file: any append (from this or another session/process) changes it;
+    # size catches appends landing within the filesystem's mtime granularity
+    _migrate_legacy_history()
+    try:
+        info = os.stat(LOCAL_FILE)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+@st.cache_data(ttl=600, max_entries=2, show_spinner=False)
+def _load_history_cached(stamp):
+    if not stamp:
+        return []
+    rows = []
+    try:
+        with open(LOCAL_FILE, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(history_loads(line))
+                except Exception:
+                    continue  # torn/partial line
+            size = f.tell()
+    except Exception:
+        return []
+    # compact once the log holds 2x the window, so the rewrite cost is amortized across appends
+    if len(rows) > 2 * MEMORY_LIMIT:
+        rows = rows[-MEMORY_LIMIT:]
+        try:
+            with _history_lock():
+                # another session appended since the read: leave it, a later load compacts
+                if os.path.getsize(LOCAL_FILE) == size:
+                    _write_history(rows)
         except Exception:
-            return []
-    return []
+            pass
+    return rows[-MEMORY_LIMIT:]
+
+
+def history_index():
+    return _history_index(_history_stamp())
+
+
+@st.cache_data(ttl=600, max_entries=2, show_spinner=False)
+def _history_index(stamp):
+    # built once per cache epoch: O(1) exact-listing lookup, and each row's similarity
+    # features (lowercased token set, price guess, location) so clicks don't re-derive them
+    by_id = {}
+    rows = []
+    for h in _load_history_cached(stamp):
+        uid = h.get("unique_ad_id")
+        if uid and uid not in by_id:
+            by_id[uid] = h
+        text = h.get("raw_text") or ""
+        price = h.get("price_guess")
+        if price is None:  # rows saved before price_guess was stored
+            price = extract_price_from_text(text)
+        rows.append((
+            uid,
+            h.get("deal_score"),
+            h.get("timestamp", ""),
+            frozenset(token_set(text)),
+            float(price or 0),
+            (h.get("from_ad") or {}).get("state_or_zip", ""),
+        ))
+    return {"by_id": by_id, "rows": rows}
 
 
 def save_history(entry):
-    data = load_history()
-    data.append(entry)
-    if len(data) > MEMORY_LIMIT:
-        data = data[-MEMORY_LIMIT:]
-    with open(LOCAL_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    _migrate_legacy_history()
+    with _history_lock(), open(LOCAL_FILE, "ab") as f:
+        f.write(history_line(entry))
+    _load_history_cached.clear()
+    _history_index.clear()
     if sheet:
+        # queued, not sent inline: the Sheets round-trip no longer blocks the results page
+        _sheet_writer(sheet).put(sheet_row(entry))
+
+
+def sheet_row(entry):
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    fa = entry.get("from_ad", {}) or {}
+    roi = entry.get("roi_forecast_24m", {}) or {}
+    gaps = entry.get("market_refs", {}) or {}
+    return [
+        ts,
+        fa.get("brand", ""),
+        fa.get("model", ""),
+        fa.get("year", ""),
+        entry.get("deal_score", ""),
+        roi.get("expected", ""),
+        entry.get("web_search_performed", ""),
+        entry.get("confidence_level", ""),
+        gaps.get("median_clean", ""),
+        gaps.get("gap_pct", ""),
+        entry.get("unique_ad_id", ""),
+        fa.get("state_or_zip", ""),
+    ]
+
+
+def sheet_append_rows(ws, rows):
+    # one spreadsheets.values.append call for any number of rows (same columns as before)
+    rng = "'{}'!A1".format(ws.title.replace("'", "''"))
+    ws.spreadsheet.values_append(
+        rng,
+        params={"valueInputOption": "USER_ENTERED", "insertDataOption": "INSERT_ROWS"},
+        body={"values": rows},
+    )
+
+
+SHEETS_LINGER = 2.0  # seconds the writer waits for more rows after the first one
+SHEETS_BATCH_MAX = 200
+
+
+@st.cache_resource(show_spinner=False)
+def _sheet_writer(_ws):
+    """One daemon thread per process drains queued rows; rows queued within the linger window or during an in-flight write go out as one batch."""
+    q = queue.Queue()
+
+    def run():
+        while True:
+            rows = [q.get()]
+            # linger briefly so saves from concurrent sessions share one write (Sheets quota is per request)
+            end = time.monotonic() + SHEETS_LINGER
+            while len(rows) < SHEETS_BATCH_MAX:
+                try:
+                    rows.append(q.get(timeout=max(0.0, end - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                sheet_append_rows(_ws, rows)
+            except Exception:
+                # server log only: a batch mixes rows from several sessions, so no one user's UI owns the failure
+                log.exception("Sheets append failed for %d row(s)", len(rows))
+            finally:
+                for _ in rows:
+                    q.task_done()
+
+    def drain(timeout=10.0):
+        end = time.time() + timeout
+        while q.unfinished_tasks and time.time() < end:
+            time.sleep(0.1)
+
+    threading.Thread(target=run, name="sheets-writer", daemon=True).start()
+    atexit.register(drain)
+    return q
+
+# -------------------------------------------------------------
+# GEMINI CALL (streaming) + RESPONSE CACHE (content-addressed: prompt + image bytes)
+# -------------------------------------------------------------
+RESPONSE_TTL = 24 * 3600
+RESPONSE_CACHE_MAX = 256
+RESPONSE_DIR = ".deal_cache"  # disk tier: survives process restarts/redeploys on the same host
+
+
+_RESPONSE_LOCK = threading.Lock()  # guards the shared in-memory tier (insert + eviction)
+
+
+@st.cache_resource(show_spinner=False)
+def _response_cache():
+    # key -> (stored_at, raw model text), oldest first; process-wide, shared by all sessions
+    return OrderedDict()
+
+
+def _remember_response(key: str, stored_at: float, text: str):
+    cache = _response_cache()
+    with _RESPONSE_LOCK:
+        cache[key] = (stored_at, text)
+        cache.move_to_end(key)
+        while len(cache) > RESPONSE_CACHE_MAX:
+            cache.popitem(last=False)
+
+
+def response_key(prompt: str, image_hashes) -> str:
+    h = hashlib.sha256(MODEL_NAME.encode() + b"\0" + prompt.encode("utf-8"))
+    for d in image_hashes:
+        h.update(d.encode())
+    return h.hexdigest()
+
+
+def _response_path(key: str) -> str:
+    return os.path.join(RESPONSE_DIR, key + ".txt")
+
+
+def cached_response(key: str):
+    hit = _response_cache().get(key)
+    if hit and time.time() - hit[0] < RESPONSE_TTL:
+        return hit[1]
+    path = _response_path(key)
+    try:
+        stored_at = os.path.getmtime(path)
+        if time.time() - stored_at >= RESPONSE_TTL:
+            os.remove(path)
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    except OSError:
+        return None
+    _remember_response(key, stored_at, text)
+    return text
+
+
+def store_response(key: str, text: str):
+    # only called once the text has parsed, so a malformed reply is never replayed on retry
+    _remember_response(key, time.time(), text)
+    try:
+        os.makedirs(RESPONSE_DIR, exist_ok=True)
+        # unique tmp per writer (two sessions may store the same key); os.replace keeps readers off half-written files
+        fd, tmp = tempfile.mkstemp(dir=RESPONSE_DIR, suffix=".tmp")
         try:
-            ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            fa = entry.get("from_ad", {}) or {}
-            roi = entry.get("roi_forecast_24m", {}) or {}
-            gaps = entry.get("market_refs", {}) or {}
-            uid = entry.get("unique_ad_id", "")
-            sheet.append_row(
-                [
-                    ts,
-                    fa.get("brand", ""),
-                    fa.get("model", ""),
-                    fa.get("year", ""),
-                    entry.get("deal_score", ""),
-                    roi.get("expected", ""),
-                    entry.get("web_search_performed", ""),
-                    entry.get("confidence_level", ""),
-                    gaps.get("median_clean", ""),
-                    gaps.get("gap_pct", ""),
-                    uid,
-                    fa.get("state_or_zip", ""),
-                ],
-                value_input_option="USER_ENTERED",
-            )
-        except Exception as e:
-            st.warning(f"Sheets write failed: {e}")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, _response_path(key))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    except OSError:
+        pass
+    _prune_response_dir()
+
+
+def drop_response(key: str):
+    with _RESPONSE_LOCK:
+        _response_cache().pop(key, None)
+    try:
+        os.remove(_response_path(key))
+    except OSError:
+        pass
+
+
+def _prune_response_dir():
+    # drop expired entries and keep at most RESPONSE_CACHE_MAX files (oldest first);
+    # runs once per fresh Gemini reply, so the directory scan is noise next to the call
+    try:
+        entries = []
+        for e in os.scandir(RESPONSE_DIR):
+            if e.name.endswith(".txt"):
+                try:
+                    entries.append((e.stat().st_mtime, e.path))
+                except OSError:
+                    continue  # removed by another session meanwhile
+    except OSError:
+        return
+    entries.sort()
+    cutoff = time.time() - RESPONSE_TTL
+    excess = len(entries) - RESPONSE_CACHE_MAX
+    for i, (mtime, path) in enumerate(entries):
+        if mtime >= cutoff and i >= excess:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def scan_json_depth(text, state=(0, False, False, False)):
+    """Incremental, string-aware bracket scan. state = (depth, in_string, escaped, started).
+
+    Nothing counts until the first "{" (prose like "Based on [KBB] data:" is skipped), and the scan
+    stops as soon as that object closes, so started and depth == 0 means the top-level object is complete.
+    """
+    depth, in_str, esc, started = state
+    if started and depth == 0:
+        return state
+    for ch in text:
+        if not started:
+            if ch == "{":
+                depth, started = 1, True
+        elif in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{" or ch == "[":
+            depth += 1
+        elif ch == "}" or ch == "]":
+            depth -= 1
+            if depth == 0:
+                break
+    return depth, in_str, esc, started
+
+
+def stream_text(parts, progress=None):
+    """generate_content(stream=True): progress from the first token; stops once the top-level JSON closes."""
+    resp = model.generate_content(parts, stream=True, request_options={"timeout": 180})
+    chunks, size = [], 0
+    state = (0, False, False, False)
+    for chunk in resp:
+        try:
+            t = chunk.text or ""
+        except ValueError:  # chunk without text parts (e.g. finish/safety metadata)
+            t = ""
+        if t:
+            chunks.append(t)
+            size += len(t)
+            if progress is not None:
+                progress.caption(f"Receiving analysis… {size:,} chars")
+            state = scan_json_depth(t, state)
+            if state[3] and state[0] == 0:
+                break  # object complete; don't wait for trailing fences/whitespace
+    return "".join(chunks)
+
+
+RETRY_NOTE = "\n\nYour previous reply was cut off or was not valid JSON. Re-emit the COMPLETE JSON object only."
+
+
+class BadReply(ValueError):
+    """The call went through but its text isn't a usable deal JSON (retry at once with RETRY_NOTE, no backoff)."""
+
+
+def parse_reply(text):
+    try:
+        return normalize_output(parse_json_safe(text))
+    except Exception as e:
+        raise BadReply(str(e)) from e
+
+
+_THROTTLED = (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded)
+
+
+def retry_delay(attempt, err):
+    # exponential backoff + jitter; 429/503/timeouts start from a longer base than one-off errors
+    base = 4.0 if isinstance(err, _THROTTLED) else 1.0
+    return min(base * 2 ** attempt + random.random(), 30.0)
+
+
+def race_attempts(parts, n):
+    """Hedged calls: start one, add another (up to n) after HEDGE_AFTER s or a bad reply; first reply that parses wins."""
+    ex = ThreadPoolExecutor(max_workers=n)
+
+    def call():
+        return getattr(model.generate_content(parts, request_options={"timeout": 180}), "text", "") or ""
+
+    pending = {ex.submit(call) for _ in range(1 if HEDGE_AFTER else n)}
+    launched, api_err, bad_reply = len(pending), None, None
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=HEDGE_AFTER if launched < n else None, return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    text = f.result()
+                except Exception as e:
+                    api_err = e
+                    continue
+                try:
+                    return text, parse_reply(text)
+                except BadReply as e:
+                    bad_reply = e
+            if launched < n and api_err is None:  # still slow, or a reply was unusable: hedge with one more call
+                pending.add(ex.submit(call))
+                launched += 1
+        # an API failure (429/503/timeout) wins so the caller backs off instead of re-prompting at once
+        if api_err is not None:
+            raise api_err
+        raise BadReply(f"no parallel attempt returned valid JSON ({bad_reply})")
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
 
 # -------------------------------------------------------------
 # EXPLANATION QUALITY GUARDRAIL
@@ -320,7 +967,7 @@ Constraints:
 - No placeholders, no instructions text, no JSON — just the explanation.
 
 Context (immutable numbers):
-{json.dumps(fields, ensure_ascii=False)}
+{prompt_json(fields)}
 """
     try:
         r2 = model.generate_content([{"text": repair_prompt}], request_options={"timeout": 120})
@@ -334,25 +981,16 @@ Context (immutable numbers):
 # -------------------------------------------------------------
 # HUMAN EXPLANATION ENGINE (U.S. Edition)
 # -------------------------------------------------------------
+_LEVEL_THRESH = (40, 50, 60, 70, 80, 90)
+_LEVELS = ("poor", "weak", "below average", "adequate", "good", "very good", "excellent")
+
+
 def explain_component(name: str, score: float, note: str = "", ctx: dict = None) -> str:
     s = clip(score, 0, 100)
     n = (note or "").strip()
     name_l = (name or "").lower().strip()
 
-    if s >= 90:
-        level = "excellent"
-    elif s >= 80:
-        level = "very good"
-    elif s >= 70:
-        level = "good"
-    elif s >= 60:
-        level = "adequate"
-    elif s >= 50:
-        level = "below average"
-    elif s >= 40:
-        level = "weak"
-    else:
-        level = "poor"
+    level = _LEVELS[bisect_right(_LEVEL_THRESH, s)]
 
     base = ""
     ctx = ctx or {}
@@ -413,20 +1051,21 @@ def explain_component(name: str, score: float, note: str = "", ctx: dict = None)
     return f"{name.capitalize()} — {int(s)}/100 → {base}"
 
 
+_DEAL_THRESH = (60, 80)
+_DEAL_VERDICTS = (
+    "❌ Bad deal — overpriced or carries notable risk factors.",
+    "⚖️ Fair deal — acceptable, but verify title/history before proceeding.",
+    "✅ Good deal — price and condition align well with U.S. market value.",
+)
+
+
 def classify_deal(score: float) -> str:
-    if score >= 80:
-        return "✅ Good deal — price and condition align well with U.S. market value."
-    if score >= 60:
-        return "⚖️ Fair deal — acceptable, but verify title/history before proceeding."
-    return "❌ Bad deal — overpriced or carries notable risk factors."
+    return _DEAL_VERDICTS[bisect_right(_DEAL_THRESH, score)]
 
 # -------------------------------------------------------------
 # PROMPT (v2.0 U.S. Anchors + Mandatory Web + Edge Cases + Warranty + ROI tiers + Risk/BF/Compliance)
 # -------------------------------------------------------------
-def build_prompt_us(ad: str, extra: str, must_id: str, exact_prev: dict, similar_summ: list):
-    exact_json = json.dumps(exact_prev or {}, ensure_ascii=False)
-    similar_json = json.dumps(similar_summ or [], ensure_ascii=False)
-    return f"""
+_PROMPT_US = """
 You are a senior U.S. used-car analyst (2023–2025). Web reasoning is REQUIRED.
 
 Stages:
@@ -565,6 +1204,12 @@ Hard constraints:
 """
 
 
+def build_prompt_us(ad: str, extra: str, must_id: str, exact_prev: dict, similar_summ: list):
+    exact_json = prompt_json(exact_prev or {})
+    similar_json = prompt_json(similar_summ or [])
+    return _PROMPT_US.format(ad=ad, extra=extra, must_id=must_id, exact_json=exact_json, similar_json=similar_json)
+
+
 # -------------------------------------------------------------
 # UI (inputs) — NO theme controls
 # -------------------------------------------------------------
@@ -609,171 +1254,174 @@ if st.button("Analyze Deal", use_container_width=True, type="primary", key="anal
 
     extra = build_extra(vin, zip_code, seller, imgs)
 
-    # ---- Memory context (exact + similar) ----
-    price_guess = extract_price_from_text(ad) or 0
-    must_id = unique_ad_id(ad, vin, zip_code, price_guess, seller)
-    history = load_history()
-    exact_prev = next((h for h in history if h.get("unique_ad_id") == must_id), None)
-
-    current_struct = {"raw_text": ad, "price_guess": price_guess, "zip_or_state": zip_code or ""}
-
-    sims = []
-    for h in history:
-        prior_struct = {
-            "raw_text": h.get("raw_text") or "",
-            "price_guess": extract_price_from_text(h.get("raw_text") or "") or 0,
-            "zip_or_state": (h.get("from_ad") or {}).get("state_or_zip", ""),
-        }
-        s = similarity_score(current_struct, prior_struct)
-        if s >= 0.85 and h.get("unique_ad_id") != must_id:
-            sims.append(
-                {"id": h.get("unique_ad_id"), "score": h.get("deal_score"), "when": h.get("timestamp", ""), "sim": round(s, 3)}
+    image_parts = prep_uploads(imgs)
+    image_hashes = [hashlib.blake2b(p["data"], digest_size=16).hexdigest() for p in image_parts]
+    # Same ad/extra/photos as the previous click -> re-render that result as-is: no Gemini call, no second
+    # blend with the history row the first click saved, no duplicate history/Sheets row
+    click_key = hashlib.blake2b("\0".join([ad, extra] + image_hashes).encode("utf-8"), digest_size=16).hexdigest()
+    last_result = st.session_state.get("_last_result")
+    reused = bool(last_result and last_result[0] == click_key)
+    if reused:
+        (data, final_score, confidence, verdict, raw_exp, comp_lines, warnings_ui, market_refs, gap_pct,
+         from_ad, title_status, state_or_zip, roi24, roi_triple, sims) = last_result[1]
+    else:
+        # ---- Memory context (exact + similar) ----
+        price_guess = extract_price_from_text(ad) or 0
+        must_id = unique_ad_id(ad, vin, zip_code, price_guess, seller)
+        current_struct = {"raw_text": ad, "price_guess": price_guess, "zip_or_state": zip_code or ""}
+        exact_prev, sims, similar_avg = history_context(history_index(), must_id, current_struct)
+
+        # ---- Build prompt & send (with memory anchors + images) ----
+        prompt = build_prompt_us(ad, extra, must_id, exact_prev or {}, sims)
+        parts = [{"text": prompt}] + image_parts
+        cache_key = response_key(prompt, image_hashes)
+
+        progress = st.empty()
+        with st.spinner("Analyzing with Gemini 2.5 Pro (U.S. web reasoning)…"):
+            data = None
+            cached = cached_response(cache_key)
+            if cached:
+                try:
+                    data = parse_reply(cached)
+                except BadReply:
+                    drop_response(cache_key)  # corrupt or pre-schema-change entry: fall through to a live call
+            for attempt in range(0 if data else MAX_ATTEMPTS):
+                try:
+                    if PARALLEL_ATTEMPTS > 1:
+                        text, data = race_attempts(parts, PARALLEL_ATTEMPTS)
+                    else:
+                        text = stream_text(parts, progress)
+                        data = parse_reply(text)
+                    store_response(cache_key, text)
+                    break
+                except Exception as e:
+                    if attempt + 1 < MAX_ATTEMPTS:
+                        st.warning(f"Retrying... ({e})")
+                        if isinstance(e, BadReply):
+                            # bad/truncated JSON: the API is fine, so retry at once and ask for the whole object
+                            parts[0] = {"text": prompt + RETRY_NOTE}
+                        else:
+                            time.sleep(retry_delay(attempt, e))
+            progress.empty()
+            if not data:
+                st.error("Model failed to return JSON. Try again.")
+                st.stop()
+
+        # ---- Sanity clamp ----
+        base_score = clip(data.get("deal_score", 60), 0, 100)
+        roi24 = data["roi_forecast_24m"]
+        for k in ["expected", "optimistic", "pessimistic"]:
+            roi24[k] = clip(roi24.get(k, 0), -50, 50)
+
+        # New ROI triple
+        roi_triple = data["roi_forecast"]
+        for k in ["12m", "24m", "36m"]:
+            roi_triple[k] = clip(roi_triple.get(k, 0), -50, 50)
+
+        facts = data["vehicle_facts"]
+        title_status = facts["title_status"]
+        market_refs = data["market_refs"]
+        gap_pct = market_refs["gap_pct"] if market_refs["gap_pct"] is not None else 0.0
+
+        # ---- Memory stabilization (score + ROI expected) ----
+        final_score = base_score
+        if exact_prev and sims and similar_avg is not None:
+            final_score = round(0.80 * base_score + 0.15 * float(exact_prev.get("deal_score", base_score)) + 0.05 * similar_avg, 1)
+        elif exact_prev:
+            final_score = round(0.75 * base_score + 0.25 * float(exact_prev.get("deal_score", base_score)), 1)
+        elif similar_avg is not None:
+            final_score = round(0.90 * base_score + 0.10 * similar_avg, 1)
+
+        prev_roi = (exact_prev or {}).get("roi_forecast_24m", {}) if exact_prev else None
+        if exact_prev and sims and similar_avg is not None:
+            roi24["expected"] = round(
+                0.80 * roi24.get("expected", 0)
+                + 0.15 * float((prev_roi or {}).get("expected", roi24.get("expected", 0)))
+                + 0.05 * (similar_avg or roi24.get("expected", 0)),
+                1,
             )
-    sims = sorted(sims, key=lambda x: -x["sim"])[:5]
-    similar_avg = None
-    if sims:
-        vals = [v["score"] for v in sims if isinstance(v.get("score"), (int, float))]
-        similar_avg = round(sum(vals) / len(vals), 2) if vals else None
-
-    # ---- Build prompt & send (with memory anchors + images) ----
-    parts = [{"text": build_prompt_us(ad, extra, must_id, exact_prev or {}, sims)}]
-    for img in imgs or []:
-        try:
-            mime = "image/png" if "png" in img.type.lower() else "image/jpeg"
-            parts.append({"mime_type": mime, "data": img.read()})
-        except Exception:
-            pass
-
-    with st.spinner("Analyzing with Gemini 2.5 Pro (U.S. web reasoning)…"):
-        data = None
-        for attempt in range(2):
-            try:
-                r = model.generate_content(parts, request_options={"timeout": 180})
-                data = parse_json_safe(getattr(r, "text", None))
-                break
-            except Exception as e:
-                if attempt == 0:
-                    st.warning(f"Retrying... ({e})")
-                    time.sleep(1.2)
-        if not data:
-            st.error("Model failed to return JSON. Try again.")
-            st.stop()
-
-    # ---- Sanity clamp ----
-    base_score = clip(data.get("deal_score", 60), 0, 100)
-    roi24 = data.get("roi_forecast_24m", {}) or {}
-    for k in ["expected", "optimistic", "pessimistic"]:
-        roi24[k] = clip(roi24.get(k, 0), -50, 50)
-
-    # New ROI triple
-    roi_triple = data.get("roi_forecast", {}) or {}
-    for k in ["12m", "24m", "36m"]:
-        roi_triple[k] = clip(roi_triple.get(k, 0), -50, 50)
-
-    facts = data.get("vehicle_facts", {}) or {}
-    title_status = str(facts.get("title_status", "unknown")).strip().lower()
-    market_refs = data.get("market_refs", {}) or {}
-    gap_pct = float(market_refs.get("gap_pct", 0)) if market_refs.get("gap_pct") is not None else 0.0
-
-    # ---- Memory stabilization (score + ROI expected) ----
-    final_score = base_score
-    if exact_prev and sims and similar_avg is not None:
-        final_score = round(0.80 * base_score + 0.15 * float(exact_prev.get("deal_score", base_score)) + 0.05 * similar_avg, 1)
-    elif exact_prev:
-        final_score = round(0.75 * base_score + 0.25 * float(exact_prev.get("deal_score", base_score)), 1)
-    elif similar_avg is not None:
-        final_score = round(0.90 * base_score + 0.10 * similar_avg, 1)
-
-    prev_roi = (exact_prev or {}).get("roi_forecast_24m", {}) if exact_prev else None
-    if exact_prev and sims and similar_avg is not None:
-        roi24["expected"] = round(
-            0.80 * roi24.get("expected", 0)
-            + 0.15 * float((prev_roi or {}).get("expected", roi24.get("expected", 0)))
-            + 0.05 * (similar_avg or roi24.get("expected", 0)),
-            1,
-        )
-    elif exact_prev:
-        try_prev = float((prev_roi or {}).get("expected", roi24.get("expected", 0)))
-        roi24["expected"] = round(0.75 * roi24.get("expected", 0) + 0.25 * try_prev, 1)
-    elif similar_avg is not None:
-        roi24["expected"] = round(0.90 * roi24.get("expected", 0) + 0.10 * (similar_avg or 0), 1)
-
-    # ---- Strict rebuilt/salvage handling (cap + ROI penalty + warnings) ----
-    warnings_ui = []
-    branded = title_status in {"rebuilt", "salvage", "branded", "flood", "lemon"}
-    if branded:
-        final_score = min(75.0, final_score - 5.0)
-        roi24["expected"] = round(roi24.get("expected", 0) - 5.0, 1)
-        warnings_ui.append("Branded/salvage title detected — insurers and lenders may limit options; resale harder.")
-
-    # ---- Rust belt / insurance context adjustments (light-touch) ----
-    state_or_zip = (facts.get("state_or_zip") or "").strip().upper()
-    state_code = ""
-    if re.fullmatch(r"[A-Z]{2}", state_or_zip):
-        state_code = state_or_zip
-    elif re.fullmatch(r"\d{5}", state_or_zip):
+        elif exact_prev:
+            try_prev = float((prev_roi or {}).get("expected", roi24.get("expected", 0)))
+            roi24["expected"] = round(0.75 * roi24.get("expected", 0) + 0.25 * try_prev, 1)
+        elif similar_avg is not None:
+            roi24["expected"] = round(0.90 * roi24.get("expected", 0) + 0.10 * (similar_avg or 0), 1)
+
+        # ---- Strict rebuilt/salvage handling (cap + ROI penalty + warnings) ----
+        warnings_ui = []
+        branded = title_status in {"rebuilt", "salvage", "branded", "flood", "lemon"}
+        if branded:
+            final_score = min(75.0, final_score - 5.0)
+            roi24["expected"] = round(roi24.get("expected", 0) - 5.0, 1)
+            warnings_ui.append("Branded/salvage title detected — insurers and lenders may limit options; resale harder.")
+
+        # ---- Rust belt / insurance context adjustments (light-touch) ----
+        state_or_zip = facts["state_or_zip"]
         state_code = ""
+        if _STATE_RE.fullmatch(state_or_zip):
+            state_code = state_or_zip
+        elif _ZIP_RE.fullmatch(state_or_zip):
+            state_code = ""
+
+        if state_code in RUST_BELT_STATES:
+            final_score = round(final_score - 1.5, 1)
+            warnings_ui.append("Rust Belt region — inspect underbody/brakes/lines for corrosion.")
+        if state_code in INSURANCE_COST and INSURANCE_COST[state_code] >= 2000:
+            warnings_ui.append(f"High average insurance cost in {state_code} — include in TCO.")
+
+        # ---- Confidence
+        confidence = clip(data["confidence_level"] * 100, 0, 100)
+
+        # ---- Components → human text lines (safe-escaped)
+        comp_lines = []
+        from_ad = data["from_ad"]
+        ctx_for_exp = {"market_refs": market_refs, "vehicle_facts": facts, "from_ad": from_ad}
+        for c in data["components"]:
+            name, score, note = c["name"], c["score"], c["note"]
+            try:
+                comp_lines.append(explain_component(name, score, note, ctx=ctx_for_exp))
+            except Exception:
+                comp_lines.append(f"{name.capitalize()} — {int(clip(score, 0, 100))}/100")
+
+        # ---- Classification
+        verdict = classify_deal(final_score)
+
+        # ---- Explanation quality check + repair if needed
+        raw_exp = data["score_explanation"]
+        if _needs_explanation_fix(raw_exp):
+            fixed = _repair_explanation(model, data)
+            if fixed:
+                data["score_explanation"] = fixed
+                raw_exp = fixed
+            else:
+                raw_exp = (
+                    "Model did not provide a sufficient rationale. "
+                    "Please ensure the listing includes year, trim, mileage, price, title, and location, then retry."
+                )
 
-    if state_code in RUST_BELT_STATES:
-        final_score = round(final_score - 1.5, 1)
-        warnings_ui.append("Rust Belt region — inspect underbody/brakes/lines for corrosion.")
-    if state_code in INSURANCE_COST and INSURANCE_COST[state_code] >= 2000:
-        warnings_ui.append(f"High average insurance cost in {state_code} — include in TCO.")
-
-    # ---- Confidence
-    confidence = clip(float(data.get("confidence_level", 0.7)) * 100, 0, 100)
-
-    # ---- Components → human text lines (safe-escaped)
-    comp_lines = []
-    components = data.get("components", []) or []
-    ctx_for_exp = {"market_refs": market_refs, "vehicle_facts": facts, "from_ad": data.get("from_ad") or {}}
-    for c in components:
-        name = c.get("name", "")
-        score = c.get("score", 0)
-        note = c.get("note", "")
-        try:
-            comp_lines.append(explain_component(name, score, note, ctx=ctx_for_exp))
-        except Exception:
-            comp_lines.append(f"{name.capitalize()} — {int(clip(score, 0, 100))}/100")
-
-    # ---- Classification
-    verdict = classify_deal(final_score)
-
-    # ---- Explanation quality check + repair if needed
-    raw_exp = data.get("score_explanation", "") or ""
-    if _needs_explanation_fix(raw_exp):
-        fixed = _repair_explanation(model, data)
-        if fixed:
-            data["score_explanation"] = fixed
-            raw_exp = fixed
-        else:
-            raw_exp = (
-                "Model did not provide a sufficient rationale. "
-                "Please ensure the listing includes year, trim, mileage, price, title, and location, then retry."
-            )
+        st.session_state["_last_result"] = (click_key, (
+            data, final_score, confidence, verdict, raw_exp, comp_lines, warnings_ui, market_refs, gap_pct,
+            from_ad, title_status, state_or_zip, roi24, roi_triple, sims,
+        ))
 
     # ---- UI OUTPUT
     st.markdown("### Deal Score")
-    meter("Deal Score", final_score, "/100")
-    st.markdown(f"<div><span class='badge'>{html.escape(verdict)}</span></div>", unsafe_allow_html=True)
+    st.markdown(
+        meter_html("Deal Score", final_score, "/100") + f"<div><span class='badge'>{html.escape(verdict)}</span></div>",
+        unsafe_allow_html=True,
+    )
 
     cols = st.columns(3)
     with cols[0]:
         meter("Confidence", confidence, "%")
     with cols[1]:
-        try:
-            ask = float(data.get("ask_price_usd", 0))
-        except Exception:
-            ask = 0.0
-        st.markdown(f"**Asking price:** ${int(ask):,}")
-        if market_refs.get("median_clean"):
-            med = float(market_refs["median_clean"])
-            st.markdown(f"**Clean-title median:** ${int(med):,}")
+        st.markdown(f"**Asking price:** ${data['ask_price_usd']:,.0f}")
+        if market_refs["median_clean"]:
+            st.markdown(f"**Clean-title median:** ${market_refs['median_clean']:,.0f}")
             st.markdown(f"**Market gap:** {gap_pct:+.0f}%")
     with cols[2]:
-        brand = str((data.get("from_ad") or {}).get("brand", "")).upper()
-        yr = (data.get("from_ad") or {}).get("year", "")
-        model_name = (data.get("from_ad") or {}).get("model", "")
+        brand = str(from_ad.get("brand") or "").upper()
+        yr = from_ad.get("year", "")
+        model_name = from_ad.get("model", "")
         st.markdown(f"**Vehicle:** {html.escape((brand or '—'))} {html.escape(str(model_name or ''))} {html.escape(str(yr or ''))}")
         st.markdown(f"**Title:** {html.escape(title_status or 'unknown')}")
         st.markdown(f"**Location:** {html.escape(state_or_zip or '—')}")
@@ -804,10 +1452,10 @@ if st.button("Analyze Deal", use_container_width=True, type="primary", key="anal
         st.metric("Pessimistic (24m)", f"{roi24.get('pessimistic', 0):+.1f}%")
 
     # Risk Tier & Buyer Fit
-    rt = data.get("risk_tier", "").strip() or "Tier 2 (average-risk)"
-    bf = data.get("buyer_fit", "").strip()
-    rr = data.get("relative_rank", "").strip()
-    verif = data.get("verification_summary", "").strip()
+    rt = data["risk_tier"] or "Tier 2 (average-risk)"
+    bf = data["buyer_fit"]
+    rr = data["relative_rank"]
+    verif = data["verification_summary"]
 
     st.markdown("<div class='section card'>", unsafe_allow_html=True)
     st.markdown(f"**Risk Tier:** {html.escape(rt)}", unsafe_allow_html=True)
@@ -834,7 +1482,7 @@ if st.button("Analyze Deal", use_container_width=True, type="primary", key="anal
         st.markdown(f"<div class='section card'><b>Warnings</b><ul>{warn_html}</ul></div>", unsafe_allow_html=True)
 
     # web lookup badge
-    web_done = bool(data.get("web_search_performed", False))
+    web_done = data["web_search_performed"]
     st.markdown(
         f"<div class='section'>Web lookup: "
         f"<span class='badge {'warn' if not web_done else ''}'>"
@@ -842,33 +1490,35 @@ if st.button("Analyze Deal", use_container_width=True, type="primary", key="anal
         unsafe_allow_html=True,
     )
 
-    # ---- Save history
-    out_entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "unique_ad_id": must_id,
-        "raw_text": ad,
-        "from_ad": {
-            "brand": (data.get("from_ad") or {}).get("brand", ""),
-            "model": (data.get("from_ad") or {}).get("model", ""),
-            "year": (data.get("from_ad") or {}).get("year", ""),
-            "state_or_zip": state_or_zip,
-        },
-        "deal_score": final_score,
-        "confidence_level": round(confidence / 100, 3),
-        "market_refs": market_refs,
-        "roi_forecast_24m": roi24,
-        "roi_forecast": roi_triple,
-        "risk_tier": rt,
-        "relative_rank": rr,
-        "buyer_fit": bf,
-        "verification_summary": verif,
-        "web_search_performed": web_done,
-    }
-    try:
-        # keep same columns in Sheets (do not alter secrets/structure)
-        save_history(out_entry)
-    except Exception as e:
-        st.warning(f"Local save failed: {e}")
+    # ---- Save history (once per result; a re-rendered duplicate click was already saved)
+    if not reused:
+        out_entry = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "unique_ad_id": must_id,
+            "raw_text": ad,
+            "price_guess": price_guess,  # parsed once here; the history index reads it instead of re-scanning raw_text
+            "from_ad": {
+                "brand": from_ad.get("brand", ""),
+                "model": from_ad.get("model", ""),
+                "year": from_ad.get("year", ""),
+                "state_or_zip": state_or_zip,
+            },
+            "deal_score": final_score,
+            "confidence_level": round(confidence / 100, 3),
+            "market_refs": market_refs,
+            "roi_forecast_24m": roi24,
+            "roi_forecast": roi_triple,
+            "risk_tier": rt,
+            "relative_rank": rr,
+            "buyer_fit": bf,
+            "verification_summary": verif,
+            "web_search_performed": web_done,
+        }
+        try:
+            # keep same columns in Sheets (do not alter secrets/structure)
+            save_history(out_entry)
+        except Exception as e:
+            st.warning(f"Local save failed: {e}")
 
     # ---- Debug panel (collapsible)
     with st.expander("Debug JSON (model output)"):